@@ -5,21 +5,29 @@ Autostuffing — сборка отгрузочных таблиц из папо
 """
 
 import gc
+import hashlib
+import os
 import re
-import shutil
 import subprocess
 import sys
 import time
+import zipfile
+from functools import lru_cache
+from itertools import chain, islice
+from xml.etree import ElementTree
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
 from copy import copy
+from io import StringIO
 
 # =============================================================================
 # КОНФИГУРАЦИЯ — можно менять при масштабировании (другие папки, пути, имена)
 # =============================================================================
 SCRIPT_DIR = Path(__file__).resolve().parent        # Папка скрипта (templates рядом)
 REQUIREMENTS_FILE = SCRIPT_DIR / "requirements.txt"
-INSTALLED_MARKER = SCRIPT_DIR / ".requirements_installed"  # Есть = библиотеки уже ставили (не ставить повторно)
+INSTALLED_MARKER = SCRIPT_DIR / ".requirements_installed"  # Хэш requirements.txt: совпал — не ставить повторно
 INVOICE_SUBFOLDER = "invoices"                      # Подпапка со счетами (относительно введённой папки)
 TEMPLATE_SUBFOLDER = "templates"                    # Папка с шаблоном (xlsx или xlsm) — всегда в папке скрипта
 # Результаты сохраняются в рабочую папку (root), подпапка output не создаётся
@@ -33,18 +41,28 @@ LAST_PATH_FILE = SCRIPT_DIR / "path.txt"  # Файл с последней ра
 # =============================================================================
 
 def _ensure_requirements_installed() -> None:
-    """При первом запуске ставит библиотеки из requirements.txt; при следующих — ничего не делает."""
-    if INSTALLED_MARKER.exists():
-        return
+    """
+    Ставит библиотеки из requirements.txt при первом запуске и после изменения requirements.txt.
+    В маркере хранится хэш файла: совпал — pip не запускается вовсе (быстрый путь — одно чтение файла).
+    """
     if not REQUIREMENTS_FILE.is_file():
         return
+    try:
+        current_hash = hashlib.blake2b(REQUIREMENTS_FILE.read_bytes(), digest_size=8).hexdigest()
+    except OSError:
+        return
+    try:
+        if INSTALLED_MARKER.is_file() and INSTALLED_MARKER.read_text(encoding="utf-8").strip() == current_hash:
+            return
+    except OSError:
+        pass
     try:
         subprocess.run(
             [sys.executable, "-m", "pip", "install", "-r", str(REQUIREMENTS_FILE)],
             check=False,
             capture_output=True,
         )
-        INSTALLED_MARKER.write_text("", encoding="utf-8")
+        INSTALLED_MARKER.write_text(current_hash, encoding="utf-8")
     except Exception:
         pass
 
@@ -72,6 +90,12 @@ COLORS = [
 ]
 RESET = "\033[0m"
 
+# Вывод перенаправлен в файл/канал — ANSI-коды там только мусор, отключаем
+_TTY = sys.stdout.isatty()
+if not _TTY:
+    COLORS = [""] * len(COLORS)
+    RESET = ""
+
 
 def _enable_ansi_windows() -> None:
     """Включает ANSI-цвета в консоли Windows."""
@@ -104,7 +128,7 @@ def _load_last_path() -> Path | None:
     return None
 
 
-_PATH_COLOR = "\033[93m"  # Жёлтый для текущего пути
+_PATH_COLOR = "\033[93m" if _TTY else ""  # Жёлтый для текущего пути
 
 
 # =============================================================================
@@ -155,31 +179,48 @@ def _strip_pack_suffix(s: str) -> str:
     """Убирает ' N pack' с конца строки (spr 16 pack → spr)."""
     if not s:
         return s
+    if "pack" not in s.lower():  # быстрый отсев — без regex
+        return s.strip()
     return _PACK_SUFFIX_PATTERN.sub("", s).strip()
 
 
+def _is_pack_part(p: str) -> bool:
+    """Часть вида "13 pack" (одно количество упаковок, без товара)."""
+    return p[-4:].lower() == "pack" and bool(_PACK_PATTERN.match(p))
+
+
 def get_group_key(folder_name: str) -> str:
     """
     Ключ группировки: приложение (после 3-й запятой) + часть 4 + порода/товар (после 5-й запятой).
     "spr 16 pack" → "spr"; не создавать отдельную таблицу под "N pack".
     """
-    parts = parse_name_by_commas(folder_name)
+    return _group_key_from_parts(parse_name_by_commas(folder_name), folder_name)
+
+
+def _group_key_from_parts(parts: list[str], folder_name: str) -> str:
+    """Ключ группировки по уже разобранным частям имени (см. get_group_key)."""
     if len(parts) < 3:
         return ""
     app = parts[3] if len(parts) > 3 else folder_name
     key_parts = [app]
     if len(parts) > 4:
-        key_parts.append(parts[4].strip())
+        key_parts.append(parts[4])
     if len(parts) > 5:
-        product = _strip_pack_suffix(parts[5].strip())
-        if product and not _PACK_PATTERN.match(product):
+        product = _strip_pack_suffix(parts[5])
+        if product and not _is_pack_part(product):
             key_parts.append(product)
     return " | ".join(key_parts)
 
 
+@lru_cache(maxsize=4096)
+def _parse_name_by_commas_cached(name: str) -> tuple[str, ...]:
+    """Кэшированный разбор: одно и то же имя папки парсится из нескольких мест за запуск."""
+    return tuple(p.strip() for p in name.split(","))
+
+
 def parse_name_by_commas(name: str) -> list[str]:
     """Разбить имя по запятым (1-я, 2-я, 3-я части и т.д.)."""
-    return [p.strip() for p in name.split(",")]
+    return list(_parse_name_by_commas_cached(name))
 
 
 def _invoice_numbers_to_range_string(numbers: list[str]) -> str:
@@ -195,19 +236,16 @@ def _invoice_numbers_to_range_string(numbers: list[str]) -> str:
     nums.sort()
     if not nums:
         return "()"
+    # Один линейный проход без индексирования: хранится начало и конец текущего диапазона
     parts: list[str] = []
-    i = 0
-    while i < len(nums):
-        start = nums[i]
-        j = i + 1
-        while j < len(nums) and nums[j] == nums[j - 1] + 1:
-            j += 1
-        end = nums[j - 1]
-        if start == end:
-            parts.append(str(start))
-        else:
-            parts.append(f"{start}-{end}")
-        i = j
+    start = prev = nums[0]
+    for n in nums[1:]:
+        if n == prev + 1:
+            prev = n
+            continue
+        parts.append(str(start) if start == prev else f"{start}-{prev}")
+        start = prev = n
+    parts.append(str(start) if start == prev else f"{start}-{prev}")
     return "(" + ";".join(parts) + ")"
 
 
@@ -216,6 +254,10 @@ def _invoice_numbers_to_range_string(numbers: list[str]) -> str:
 # При масштабировании: parse_name_by_commas, _invoice_numbers_to_range_string, формат имени
 # =============================================================================
 
+# Замена запрещённых в именах файлов символов на "_" — str.translate быстрее re.sub
+_FS_UNSAFE_TABLE = str.maketrans({c: "_" for c in '\\/:*?"<>|'})
+
+
 def build_upload_table_filename(
     template_name: str,
     invoice_folder_name: str,
@@ -231,8 +273,7 @@ def build_upload_table_filename(
     # "N pack" не попадает в имя; "spr 16 pack" → "spr"
     i_parts = []
     for p in parse_name_by_commas(invoice_folder_name):
-        p = p.strip()
-        if _PACK_PATTERN.match(p):  # отдельная часть "13 pack" — пропускаем
+        if _is_pack_part(p):  # отдельная часть "13 pack" — пропускаем
             continue
         p = _strip_pack_suffix(p)  # "spr 16 pack" → "spr"
         if p:
@@ -244,10 +285,10 @@ def build_upload_table_filename(
     else:
         first_part = t_parts[0] if t_parts else "() pcs."
     # Первая часть — диапазон+кол-во или из шаблона, вторая из шаблона, остальное из папки
-    result = [first_part] + (t_parts[1:2] if len(t_parts) > 1 else []) + i_parts[2:]
-    name_parts = [p for p in result if p]
-    raw = ", ".join(name_parts)
-    return re.sub(r'[\\/:*?"<>|]', "_", raw).strip(",_") or "upload_table"
+    raw = ", ".join(
+        filter(None, chain((first_part,), islice(t_parts, 1, 2), islice(i_parts, 2, None)))
+    )
+    return raw.translate(_FS_UNSAFE_TABLE).strip(",_") or "upload_table"
 
 
 # =============================================================================
@@ -256,10 +297,21 @@ def build_upload_table_filename(
 # При масштабировании: _SHEET_ZOOM_PERCENT, _copy_sheet_print_and_view, _copy_cell_style
 # =============================================================================
 
-def _copy_cell_style(src_cell, tgt_cell) -> None:
-    """Копирует значение и оформление ячейки (между книгами). Формулы копируются как формулы."""
+# Буквы столбцов, посчитанные один раз на весь диапазон XLSX (16384 столбца)
+_COL_LETTERS = [""] + [get_column_letter(i) for i in range(1, 16385)]
+
+
+def _copy_cell_style(src_cell, tgt_cell, style_cache: dict | None = None) -> None:
+    """
+    Копирует значение и оформление ячейки (между книгами). Формулы копируются как формулы.
+    style_cache — кэш копий стилей одной исходной книги: в счёте тысячи ячеек, но лишь
+    несколько различных стилей, поэтому copy() выполняется один раз на стиль, а не на ячейку.
+    """
     tgt_cell.value = src_cell.value
-    if src_cell.has_style:
+    if not src_cell.has_style:
+        return
+    style = getattr(src_cell, "_style", None)
+    if style_cache is None or style is None:
         if src_cell.font:
             tgt_cell.font = copy(src_cell.font)
         if src_cell.border:
@@ -270,6 +322,30 @@ def _copy_cell_style(src_cell, tgt_cell) -> None:
             tgt_cell.alignment = copy(src_cell.alignment)
         if src_cell.number_format:
             tgt_cell.number_format = src_cell.number_format
+        return
+    # Индексы в StyleArray однозначно определяют стиль внутри исходной книги
+    if src_cell.font:
+        cached = style_cache.get(("font", style.fontId))
+        if cached is None:
+            cached = style_cache[("font", style.fontId)] = copy(src_cell.font)
+        tgt_cell.font = cached
+    if src_cell.border:
+        cached = style_cache.get(("border", style.borderId))
+        if cached is None:
+            cached = style_cache[("border", style.borderId)] = copy(src_cell.border)
+        tgt_cell.border = cached
+    if src_cell.fill:
+        cached = style_cache.get(("fill", style.fillId))
+        if cached is None:
+            cached = style_cache[("fill", style.fillId)] = copy(src_cell.fill)
+        tgt_cell.fill = cached
+    if src_cell.alignment:
+        cached = style_cache.get(("alignment", style.alignmentId))
+        if cached is None:
+            cached = style_cache[("alignment", style.alignmentId)] = copy(src_cell.alignment)
+        tgt_cell.alignment = cached
+    if src_cell.number_format:
+        tgt_cell.number_format = src_cell.number_format
 
 
 def _copy_sheet_print_and_view(ws_src, ws_tgt) -> None:
@@ -313,13 +389,61 @@ def _set_sheet_zoom_25(ws_tgt) -> None:
         print(f"  [ошибка] масштаб листа: {e}")
 
 
+# Кэш имён первых листов: (путь, mtime) → имя. Один и тот же счёт читается несколько раз за запуск
+_FIRST_SHEET_NAME_CACHE: dict[tuple[str, float], str] = {}
+
+# Потоков на параллельное чтение имён листов (чтение xlsx — I/O + распаковка zip)
+_TITLE_PREFETCH_WORKERS = 8
+
+
+def _prefetch_sheet_titles(paths: list[Path]) -> None:
+    """Параллельно прогревает кэш имён первых листов (ошибки всплывут при обычном чтении)."""
+    if len(paths) < 2:
+        return
+    workers = min(_TITLE_PREFETCH_WORKERS, len(paths))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(lambda p: _safe_first_sheet_name(p), paths):
+            pass
+
+
+def _safe_first_sheet_name(path: Path) -> str | None:
+    try:
+        return get_first_sheet_name(path)
+    except Exception:
+        return None
+
+
+def _read_first_sheet_title_fast(xlsx_path: Path) -> str | None:
+    """
+    Имя первого листа напрямую из xl/workbook.xml (zip + ElementTree), без openpyxl:
+    не парсятся styles.xml и sharedStrings.xml. None — если файл не удалось разобрать.
+    """
+    try:
+        with zipfile.ZipFile(xlsx_path) as z:
+            data = z.read("xl/workbook.xml")
+        for el in ElementTree.fromstring(data).iter():
+            if el.tag.rpartition("}")[2] == "sheet":
+                return el.get("name")
+    except Exception:
+        pass
+    return None
+
+
 def get_first_sheet_name(xlsx_path: Path) -> str:
     """Возвращает имя первого листа в xlsx (номер/имя счёта для проверки «уже в отгрузочной таблице»)."""
-    wb = load_workbook(xlsx_path, read_only=True)
-    try:
-        return wb.worksheets[0].title
-    finally:
-        wb.close()
+    key = (str(xlsx_path), xlsx_path.stat().st_mtime)
+    cached = _FIRST_SHEET_NAME_CACHE.get(key)
+    if cached is not None:
+        return cached
+    title = _read_first_sheet_title_fast(xlsx_path)
+    if title is None:
+        wb = load_workbook(xlsx_path, read_only=True)
+        try:
+            title = wb.worksheets[0].title
+        finally:
+            wb.close()
+    _FIRST_SHEET_NAME_CACHE[key] = title
+    return title
 
 
 def copy_first_sheet_to_workbook(
@@ -328,7 +452,15 @@ def copy_first_sheet_to_workbook(
     new_sheet_name: str | None = None,
 ) -> None:
     """Копирует первый лист из xlsx в целевую книгу (отгрузочную таблицу): ячейки, формат, область печати, настройки страницы, видимую область."""
-    wb_src = load_workbook(source_xlsx_path, read_only=False, data_only=False)
+    wb_src = load_workbook(source_xlsx_path, read_only=False, data_only=False, keep_links=False)
+    try:
+        _copy_first_sheet_from_wb(wb_src, target_wb, new_sheet_name)
+    finally:
+        wb_src.close()
+
+
+def _copy_first_sheet_from_wb(wb_src, target_wb, new_sheet_name: str | None = None) -> None:
+    """Как copy_first_sheet_to_workbook, но по уже открытой исходной книге (без повторного чтения файла)."""
     ws_src = wb_src.worksheets[0]
     name = (new_sheet_name or ws_src.title)[:31]
     existing = {s.title for s in target_wb.worksheets}
@@ -338,11 +470,17 @@ def copy_first_sheet_to_workbook(
             n += 1
         name = f"{base}_{n}"[:31]
     ws_tgt = target_wb.create_sheet(title=name)
-    for row in range(1, ws_src.max_row + 1):
-        for col in range(1, ws_src.max_column + 1):
-            src_c = ws_src.cell(row=row, column=col)
-            tgt_c = ws_tgt.cell(row=row, column=col)
-            _copy_cell_style(src_c, tgt_c)
+    # iter_rows вместо ws.cell(row, col) на каждую ячейку — в разы меньше поиска по словарю _cells
+    tgt_cell = ws_tgt.cell
+    style_cache: dict = {}  # стили исходной книги копируем по одному разу
+    for r, src_row in enumerate(
+        ws_src.iter_rows(min_row=1, max_row=ws_src.max_row, max_col=ws_src.max_column), 1
+    ):
+        for src_c in src_row:
+            # Пустые ячейки без оформления не переносим — незачем создавать Cell в целевой книге
+            if src_c.value is None and not src_c.has_style:
+                continue
+            _copy_cell_style(src_c, tgt_cell(row=r, column=src_c.column), style_cache)
     # Ширина столбцов — копируем размеры, скрытие НЕ копируем (все столбцы видимы)
     for col_key, src_dim in list(ws_src.column_dimensions.items()):
         if src_dim is None or getattr(src_dim, "width", None) is None:
@@ -352,11 +490,11 @@ def copy_first_sheet_to_workbook(
         max_col = getattr(src_dim, "max", None)
         if min_col is not None and max_col is not None:
             for c in range(min_col, max_col + 1):
-                col_letter = get_column_letter(c)
+                col_letter = _COL_LETTERS[c]
                 ws_tgt.column_dimensions[col_letter].width = w
                 ws_tgt.column_dimensions[col_letter].hidden = False
         else:
-            col_letter = get_column_letter(col_key) if isinstance(col_key, int) else str(col_key)
+            col_letter = _COL_LETTERS[col_key] if isinstance(col_key, int) else str(col_key)
             ws_tgt.column_dimensions[col_letter].width = w
             ws_tgt.column_dimensions[col_letter].hidden = False
     # Высота строк — копируем размеры, скрытие НЕ копируем (все строки видимы)
@@ -364,13 +502,16 @@ def copy_first_sheet_to_workbook(
         if src_dim is not None and getattr(src_dim, "height", None) is not None:
             ws_tgt.row_dimensions[row_key].height = src_dim.height
             ws_tgt.row_dimensions[row_key].hidden = False
+    # Диапазоны объединения переносим копией объекта — без str() и повторного разбора координат
     for merged in ws_src.merged_cells.ranges:
-        ws_tgt.merge_cells(str(merged))
-    # Снимаем скрытие со всех столбцов и строк — как в счёте, но всё видно
-    for c in range(1, ws_src.max_column + 1):
-        ws_tgt.column_dimensions[get_column_letter(c)].hidden = False
-    for row_key in list(ws_tgt.row_dimensions):
-        ws_tgt.row_dimensions[row_key].hidden = False
+        merged_copy = copy(merged)
+        merged_copy.ws = ws_tgt
+        ws_tgt.merged_cells.ranges.add(merged_copy)
+    # Снимаем скрытие только с реально созданных размерностей — остальные и так видимы
+    for dim in ws_tgt.column_dimensions.values():
+        dim.hidden = False
+    for dim in ws_tgt.row_dimensions.values():
+        dim.hidden = False
     _copy_sheet_print_and_view(ws_src, ws_tgt)
     # Режим просмотра «Страничный режим» (Page Break Preview) + масштаб 25%
     try:
@@ -378,7 +519,6 @@ def copy_first_sheet_to_workbook(
         _set_sheet_zoom_25(ws_tgt)
     except Exception:
         pass
-    wb_src.close()
 
 
 # =============================================================================
@@ -395,6 +535,18 @@ def _should_skip_invoice_file(path: Path) -> bool:
     return bool(_INVOICE_SKIP_PATTERN.match(path.name))
 
 
+def _iter_invoice_xlsx(folder: Path):
+    """
+    Обрабатываемые xlsx-счета папки (рекурсивно, как rglob, но через os.walk —
+    без Path-объекта и stat на каждый файл). Временные ~$ и invoice N fcs/custom пропускаются.
+    """
+    for dirpath, _dirnames, filenames in os.walk(folder):
+        for name in filenames:
+            if name.lower().endswith(".xlsx") and not name.startswith("~$") \
+                    and not _INVOICE_SKIP_PATTERN.match(name):
+                yield Path(dirpath) / name
+
+
 _ESD_PATTERN = re.compile(r"^([\w-]+)\.pdf$", re.IGNORECASE)
 _GTD_PATTERN = re.compile(r"^GTD_(\d+)_(\d+)_(\d+)\.pdf$", re.IGNORECASE)
 _ESD_HYPHEN_COUNT = 4  # ЭСД — только PDF с ровно 4 дефисами в имени (3486.pdf — не ЭСД)
@@ -426,29 +578,45 @@ def _get_sorted_invoice_numbers_from_wb(wb) -> list[str]:
 
 def _is_esd_file(name: str) -> bool:
     """PDF считается ЭСД только если в имени ровно 4 дефиса (3486.pdf — не ЭСД)."""
-    return bool(_ESD_PATTERN.match(name) and name.count("-") == _ESD_HYPHEN_COUNT)
+    return name.count("-") == _ESD_HYPHEN_COUNT and bool(_ESD_PATTERN.match(name))
+
+
+def _parse_gtd_name(name: str) -> str | None:
+    """GTD_a_b_c.pdf → "a/b/c", иначе None. Ручной разбор вместо regex на каждый файл."""
+    pieces = name[4:-4].split("_")
+    if len(pieces) == 3 and all(p.isdigit() for p in pieces):
+        return "/".join(pieces)
+    return None
+
+
+# Кэш результатов сканирования папок счетов: и лист Total, и итоговая сводка ходят по одним папкам
+_ESD_GTD_CACHE: dict[str, tuple[list[str], list[str]]] = {}
 
 
 def _collect_esd_and_gtd_from_one_folder(folder: Path) -> tuple[list[str], list[str]]:
     """
     Сканирует одну папку счёта: номера ЭСД (PDF с 4 дефисами, не GTD_) и декларации (GTD_a_b_c.pdf).
-    Возвращает (esd_list, gtd_list).
+    Возвращает (esd_list, gtd_list). Результат кэшируется на время запуска.
     """
+    cached = _ESD_GTD_CACHE.get(str(folder))
+    if cached is not None:
+        return cached
     esd_list: list[str] = []
     gtd_list: list[str] = []
-    if not folder.is_dir():
-        return esd_list, gtd_list
-    for f in folder.iterdir():
-        if not f.is_file():
-            continue
-        name = f.name
-        if name.startswith("GTD_"):
-            gtd_match = _GTD_PATTERN.match(name)
-            if gtd_match:
-                gtd_list.append(f"{gtd_match.group(1)}/{gtd_match.group(2)}/{gtd_match.group(3)}")
-            continue
-        if _is_esd_file(name):
-            esd_list.append(name[:-4])
+    if folder.is_dir():
+        with os.scandir(folder) as it:
+            for entry in it:
+                name = entry.name
+                if not name.lower().endswith(".pdf") or not entry.is_file():
+                    continue
+                if name.startswith("GTD_"):
+                    gtd = _parse_gtd_name(name)
+                    if gtd is not None:
+                        gtd_list.append(gtd)
+                    continue
+                if _is_esd_file(name):
+                    esd_list.append(name[:-4])
+    _ESD_GTD_CACHE[str(folder)] = (esd_list, gtd_list)
     return esd_list, gtd_list
 
 
@@ -465,33 +633,30 @@ def _fill_total_sheet(wb, inv_to_folder: dict[str, Path]) -> None:
         if not sorted_numbers:
             target.cell(row=4, column=2, value="")
             return
-        n = len(sorted_numbers)
-        for r in range(4, 4 + n):
-            target.cell(row=r, column=2, value="")
-            target.cell(row=r, column=_COL_ESD, value="")
-            target.cell(row=r, column=_COL_GTD, value="")
+        # Один проход: каждая ячейка диапазона записывается ровно один раз
+        cell = target.cell  # локальная привязка вместо поиска атрибута на каждую ячейку
+        col_esd, col_gtd = _COL_ESD, _COL_GTD
         for i, inv_num in enumerate(sorted_numbers):
-            target.cell(row=4 + i, column=2, value=inv_num)
+            row = 4 + i
+            cell(row=row, column=2, value=inv_num)
             folder = inv_to_folder.get(inv_num)
             if folder is None:
-                target.cell(row=4 + i, column=_COL_ESD, value=_EMPTY_PASS)
-                target.cell(row=4 + i, column=_COL_GTD, value=_EMPTY_PASS)
+                cell(row=row, column=col_esd, value=_EMPTY_PASS)
+                cell(row=row, column=col_gtd, value=_EMPTY_PASS)
             else:
                 esd_list, gtd_list = _collect_esd_and_gtd_from_one_folder(folder)
-                esd_str = ", ".join(esd_list) if esd_list else _EMPTY_PASS
-                gtd_str = ", ".join(gtd_list) if gtd_list else _EMPTY_PASS
-                target.cell(row=4 + i, column=_COL_ESD, value=esd_str)
-                target.cell(row=4 + i, column=_COL_GTD, value=gtd_str)
+                cell(row=row, column=col_esd, value=", ".join(esd_list) if esd_list else _EMPTY_PASS)
+                cell(row=row, column=col_gtd, value=", ".join(gtd_list) if gtd_list else _EMPTY_PASS)
     except Exception as e:
         print(f"  [ошибка] лист Total: {e}")
 
 
 def _invoice_number_sort_key(s: str) -> int:
     """Ключ для сортировки по числовому значению номера счёта (1, 2, 3 … 10, 11)."""
-    s = str(s).strip()
-    if s.isdigit():
+    try:
         return int(s)
-    return 0
+    except (TypeError, ValueError):
+        return 0
 
 
 def _sort_invoice_numbers_as_int(numbers: list[str]) -> list[str]:
@@ -499,46 +664,45 @@ def _sort_invoice_numbers_as_int(numbers: list[str]) -> list[str]:
     return sorted(numbers, key=_invoice_number_sort_key)
 
 
+# Кэш статистики папок счетов: (число xlsx, число ЭСД, число GTD) — один обход на папку за запуск
+_FOLDER_STATS_CACHE: dict[str, tuple[int, int, int]] = {}
+
+
+def _scan_invoice_folder(folder: Path) -> tuple[int, int, int]:
+    """
+    Один проход по папке счёта: (число xlsx, число ЭСД, число GTD).
+    xlsx считаются рекурсивно (как rglob), PDF — только в самой папке. Кэшируется на время запуска.
+    """
+    cached = _FOLDER_STATS_CACHE.get(str(folder))
+    if cached is not None:
+        return cached
+    xlsx_count = sum(1 for _ in _iter_invoice_xlsx(folder)) if folder.is_dir() else 0
+    esd_list, gtd_list = _collect_esd_and_gtd_from_one_folder(folder)
+    stats = (xlsx_count, len(esd_list), len(gtd_list))
+    _FOLDER_STATS_CACHE[str(folder)] = stats
+    return stats
+
+
 def count_invoices_in_folders(folders: list[Path]) -> int:
     """Количество xlsx-счетов в переданных папках (без invoice N fcs/custom и т.п.)."""
-    return sum(
-        1 for folder in folders
-        for p in folder.rglob("*.xlsx")
-        if not p.name.startswith("~$") and not _should_skip_invoice_file(p)
-    )
+    return sum(_scan_invoice_folder(folder)[0] for folder in folders)
 
 
 def _folders_without_xlsx(folders: list[Path]) -> list[Path]:
     """Папки, в которых нет ни одного обрабатываемого .xlsx."""
-    empty: list[Path] = []
-    for folder in folders:
-        if not folder.is_dir():
-            continue
-        has_xlsx = any(
-            not p.name.startswith("~$") and not _should_skip_invoice_file(p)
-            for p in folder.rglob("*.xlsx")
-        )
-        if not has_xlsx:
-            empty.append(folder)
-    return empty
+    return [
+        folder for folder in folders
+        if folder.is_dir() and _scan_invoice_folder(folder)[0] == 0
+    ]
 
 
 def _count_esd_gtd_in_folders(folders: list[Path]) -> tuple[int, int]:
     """Количество документов ЭСД и GTD (PDF) в папках. Возвращает (число_ЭСД, число_GTD)."""
     esd_count, gtd_count = 0, 0
     for folder in folders:
-        if not folder.is_dir():
-            continue
-        for f in folder.iterdir():
-            if not f.is_file():
-                continue
-            name = f.name
-            if name.startswith("GTD_"):
-                if _GTD_PATTERN.match(name):
-                    gtd_count += 1
-                continue
-            if _is_esd_file(name):
-                esd_count += 1
+        esd_list, gtd_list = _collect_esd_and_gtd_from_one_folder(folder)
+        esd_count += len(esd_list)
+        gtd_count += len(gtd_list)
     return esd_count, gtd_count
 
 
@@ -556,15 +720,16 @@ def analyze_and_group_invoice_folders(base_path: Path) -> dict[str, list[Path]]:
     if not base_path.is_dir():
         return {}
     by_group = defaultdict(list)
-    for item in base_path.iterdir():
-        if item.is_dir() and not item.name.startswith("."):
-            parts = parse_name_by_commas(item.name)
-            if len(parts) < 3:
+    with os.scandir(base_path) as it:
+        for entry in it:
+            name = entry.name
+            # Быстрый отсев до разбора: минимум 3 части = минимум 2 запятые в имени
+            if name.startswith(".") or name.count(",") < 2 or not entry.is_dir():
                 continue
-            key = get_group_key(item.name)
+            key = _group_key_from_parts(parse_name_by_commas(name), name)
             if not key:
                 continue
-            by_group[key].append(item)
+            by_group[key].append(Path(entry.path))
     return dict(by_group)
 
 
@@ -578,11 +743,13 @@ def process_application(
     invoice_folders: list[Path],
     template_path: Path,
     output_dir: Path,
-) -> int:
+) -> tuple[int, Path, list[str]]:
     """
     Для каждого приложения: если отгрузочная таблица уже есть — добавляем только новые счета
     (по имени первого листа: если такой лист уже в таблице, счёт не копируем). Если таблицы нет —
     создаём из шаблона и копируем первый лист из всех xlsx.
+    Возвращает (число добавленных листов, путь к таблице, отсортированные номера счетов) —
+    номера нужны для переименования без повторного открытия книги.
     """
     template_name = template_path.stem
     first_folder_name = invoice_folders[0].name
@@ -596,24 +763,28 @@ def process_application(
     file_base = build_upload_table_filename(template_name, first_folder_name)
     out_path = output_dir / f"{file_base}{ext}"
 
+    # Все xlsx-счета группы собираем один раз; имена листов читаем параллельно (кэш)
+    candidates: list[tuple[Path, Path]] = []  # (xlsx, папка счёта)
+    for folder in invoice_folders:
+        if not folder.is_dir():
+            continue
+        for path in _iter_invoice_xlsx(folder):
+            candidates.append((path, folder))
+    _prefetch_sheet_titles([p for p, _ in candidates])
+
     if out_path.exists():
         wb = load_workbook(out_path, keep_vba=keep_vba)
         existing_sheet_names = {s.title for s in wb.worksheets}
         inv_to_folder: dict[str, Path] = {}
         new_paths: list[tuple[Path, str]] = []
-        for folder in invoice_folders:
-            if not folder.is_dir():
-                continue
-            for path in folder.rglob("*.xlsx"):
-                if path.name.startswith("~$") or _should_skip_invoice_file(path):
-                    continue
-                try:
-                    sheet_name = get_first_sheet_name(path)
-                    inv_to_folder[sheet_name] = folder
-                    if sheet_name not in existing_sheet_names:
-                        new_paths.append((path, sheet_name))
-                except Exception as e:
-                    print(f"  Пропуск {path.name}: {e}")
+        for path, folder in candidates:
+            try:
+                sheet_name = get_first_sheet_name(path)
+                inv_to_folder[sheet_name] = folder
+                if sheet_name not in existing_sheet_names:
+                    new_paths.append((path, sheet_name))
+            except Exception as e:
+                print(f"  Пропуск {path.name}: {e}")
         new_paths.sort(key=lambda x: _invoice_number_sort_key(x[1]))
         added = 0
         if new_paths:
@@ -635,27 +806,17 @@ def process_application(
             print(f"  {COLORS[0]}Готово: {out_path.name} (обновлены ЭСД/GTD на листе Total){RESET}")
         return added, out_path, sorted_numbers
     else:
-        all_paths: list[tuple[Path, Path]] = []
-        for folder in invoice_folders:
-            if not folder.is_dir():
-                continue
-            for path in folder.rglob("*.xlsx"):
-                if path.name.startswith("~$") or _should_skip_invoice_file(path):
-                    continue
-                all_paths.append((path, folder))
         # Сортируем по числовому значению номера счёта (1, 2, 3 … 10, 11)
         all_with_name: list[tuple[Path, Path, str]] = []
-        for path, folder in all_paths:
+        for path, folder in candidates:
             try:
                 sn = get_first_sheet_name(path)
                 all_with_name.append((path, folder, sn))
             except Exception:
                 pass
         all_with_name.sort(key=lambda x: _invoice_number_sort_key(x[2]))
-        file_base = build_upload_table_filename(template_name, first_folder_name)
-        out_path = output_dir / f"{file_base}{ext}"
-        shutil.copy2(template_path, out_path)
-        wb = load_workbook(out_path, keep_vba=keep_vba)
+        # Читаем шаблон напрямую: без предварительного shutil.copy2 + повторного чтения копии
+        wb = load_workbook(template_path, keep_vba=keep_vba)
         inv_to_folder: dict[str, Path] = {}
         copied = 0
         for path, folder, _ in all_with_name:
@@ -680,26 +841,71 @@ def process_application(
 # При масштабировании: структура main, выбор переименования, вывод в консоль
 # =============================================================================
 
+def _process_application_task(args: tuple) -> tuple:
+    """
+    Обёртка process_application для пула процессов: вывод перехватывается в строку,
+    чтобы напечатать его в главном процессе в исходном порядке приложений.
+    Возвращает (count, out_path | None, numbers, (счетов, ЭСД, GTD), вывод, текст ошибки | None).
+    """
+    app_name, folders, template_path, output_dir = args
+    buf = StringIO()
+    count, out_path, numbers, error = 0, None, [], None
+    try:
+        with redirect_stdout(buf):
+            count, out_path, numbers = process_application(app_name, folders, template_path, output_dir)
+    except Exception as e:
+        error = str(e)
+    # Сводку считаем здесь же: кэши сканирования папок прогреты обработкой, второй обход бесплатный
+    stats = (count_invoices_in_folders(folders), *_count_esd_gtd_in_folders(folders))
+    return count, out_path, numbers, stats, buf.getvalue(), error
+
+
+def _find_templates_quietly(template_folder: Path) -> list[Path]:
+    """_find_templates для фоновой задачи: ошибки ФС не всплывают (папку проверит main)."""
+    try:
+        return _find_templates(template_folder)
+    except OSError:
+        return []
+
+
+def _find_templates(template_folder: Path, limit: int = 2) -> list[Path]:
+    """
+    Первые limit шаблонов (.xlsx/.xlsm, без временных ~$) из папки.
+    Используются только первый шаблон и факт «их больше одного», поэтому дальше не сканируем.
+    """
+    found: list[Path] = []
+    with os.scandir(template_folder) as it:
+        for e in it:
+            if not e.name.startswith("~$") and e.name.lower().endswith((".xlsx", ".xlsm")) \
+                    and e.is_file(follow_symlinks=False):
+                found.append(Path(e.path))
+                if len(found) >= limit:
+                    break
+    return found
+
+
 def main():
-    _enable_ansi_windows()
+    if _TTY:  # на перенаправленном выводе консольные вызовы не нужны
+        _enable_ansi_windows()
     print("\n  === Отгрузочные таблицы ===")
     print("  Укажите путь или Enter (тот же путь).\n")
+    # Поиск шаблона (.xlsx/.xlsm, без временных ~$) идёт в фоне, пока пользователь вводит путь
+    template_folder = SCRIPT_DIR / TEMPLATE_SUBFOLDER
+    discovery = ThreadPoolExecutor(max_workers=1)
+    templates_future = discovery.submit(_find_templates_quietly, template_folder)
     try:
         root = ask_work_directory()
     except FileNotFoundError as e:
         print(e)
+        discovery.shutdown(wait=False)
         return
 
-    template_folder = SCRIPT_DIR / TEMPLATE_SUBFOLDER
+    template_files = templates_future.result()
+    discovery.shutdown()
     if not template_folder.is_dir():
         print(f"Папка шаблона не найдена: {template_folder}")
         print("Папка 'templates' должна быть в одной папке со скриптом Autostuffing.py")
         return
-    # Шаблон — любой .xlsx или .xlsm в папке templates (без временных ~$)
-    template_files = [
-        f for f in template_folder.iterdir()
-        if f.is_file() and f.suffix.lower() in (".xlsx", ".xlsm") and not f.name.startswith("~$")
-    ]
     if not template_files:
         print(f"В папке {template_folder} нет файла .xlsx или .xlsm. Добавьте туда отгрузочную таблицу.")
         return
@@ -720,78 +926,85 @@ def main():
     output_dir = root
 
     # Обработка приложений; список для опционального переименования (с номерами — без повторного открытия)
+    # Приложения независимы (свой файл таблицы у каждого) — обрабатываем пулом процессов
     total_processed = 0
     rename_list: list[tuple[Path, str, str, list[str]]] = []  # (out_path, template_name, first_folder_name, numbers)
-    for i, (app_name, folders) in enumerate(by_app.items()):
-        app_color = COLORS[i % len(COLORS)]
-        print(f"\n  {app_color}─── Приложение: {app_name} ───{RESET}")
-        try:
-            count, out_path, sorted_numbers = process_application(
-                app_name,
-                folders,
-                template_path,
-                output_dir,
-            )
-            total_processed += count
-            rename_list.append((out_path, template_path.stem, folders[0].name, sorted_numbers))
-        except Exception as e:
-            print(f"  Ошибка: {e}")
-
-    # Итоговая сводка: приложения, счета, ЭСД, GTD
-    print("\n  " + "=" * 52)
-    print("  ИТОГИ")
-    print("  " + "=" * 52)
+    apps = list(by_app.items())
+    app_colors = [COLORS[i % len(COLORS)] for i in range(len(apps))]  # цвет приложения — один раз
+    template_stem = template_path.stem  # одно и то же для всех приложений
+    tasks = [(app_name, folders, template_path, output_dir) for app_name, folders in apps]
+    workers = min(len(apps), os.cpu_count() or 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_process_application_task, tasks))
+    else:
+        results = [_process_application_task(t) for t in tasks]
+    # Один проход по результатам: вывод обработки, итоговые суммы и строки сводки сразу
     total_inv, total_esd, total_gtd = 0, 0, 0
-    for i, (app_name, folders) in enumerate(by_app.items()):
-        inv = count_invoices_in_folders(folders)
-        esd, gtd = _count_esd_gtd_in_folders(folders)
+    summary_rows: list[str] = []
+    for (app_name, folders), (count, out_path, sorted_numbers, (inv, esd, gtd), output, error), app_color in zip(
+        apps, results, app_colors
+    ):
+        print(f"\n  {app_color}─── Приложение: {app_name} ───{RESET}")
+        if output:
+            print(output, end="")
         total_inv += inv
         total_esd += esd
         total_gtd += gtd
-        color = COLORS[i % len(COLORS)]
-        print(f"  {color}{app_name}{RESET}")
-        print(f"      счетов: {inv:>4}   ЭСД: {esd:>4}   GTD: {gtd:>4}")
-    print("  " + "-" * 52)
-    print(f"  Всего приложений: {len(by_app)}")
-    print(f"  Всего инвойсов: {total_inv:>4}")
-    print(f"  Всего ЭСД: {total_esd:>4}")
-    print(f"  Всего ДТ: {total_gtd:>4}")
-    print("  " + "=" * 52)
+        summary_rows.append(f"  {app_color}{app_name}{RESET}")
+        summary_rows.append(f"      счетов: {inv:>4}   ЭСД: {esd:>4}   GTD: {gtd:>4}")
+        if error is not None:
+            print(f"  Ошибка: {error}")
+            continue
+        total_processed += count
+        rename_list.append((out_path, template_stem, folders[0].name, sorted_numbers))
+
+    # Итоговая сводка: приложения, счета, ЭСД, GTD — собираем целиком и выводим одной записью
+    lines = ["", "  " + "=" * 52, "  ИТОГИ", "  " + "=" * 52]
+    lines.extend(summary_rows)
+    lines.append("  " + "-" * 52)
+    lines.append(f"  Всего приложений: {len(apps)}")
+    lines.append(f"  Всего инвойсов: {total_inv:>4}")
+    lines.append(f"  Всего ЭСД: {total_esd:>4}")
+    lines.append(f"  Всего ДТ: {total_gtd:>4}")
+    lines.append("  " + "=" * 52)
+    sys.stdout.write("\n".join(lines) + "\n")
 
     # Перед выбором переименования — закрыть все хэндлы openpyxl (сборка мусора + пауза)
     gc.collect()
     time.sleep(0.3)
 
     # Выбор: закрыть без изменения имён или добавить диапазон счетов в имена
-    while True:
-        print(f"\n  {COLORS[4]}1 — закрыть без изменения имён файлов{RESET}")
-        print(f"  {COLORS[4]}2 — добавить диапазон счетов и количество в имена файлов{RESET}")
-        choice = input("  Ваш выбор (1 или 2): ").strip()
-        if choice == "1":
-            break
-        if choice == "2":
-            ext = template_path.suffix.lower()
-            for out_path, template_name, first_folder_name, numbers in rename_list:
-                if not out_path.exists():
+    # Текст меню собирается один раз, цикл только проверяет ввод
+    menu_prompt = (
+        f"\n  {COLORS[4]}1 — закрыть без изменения имён файлов{RESET}"
+        f"\n  {COLORS[4]}2 — добавить диапазон счетов и количество в имена файлов{RESET}"
+        "\n  Ваш выбор (1 или 2): "
+    )
+    while (choice := input(menu_prompt).strip()) not in ("1", "2"):
+        print("  Введите 1 или 2.")
+    if choice == "2":
+        ext = template_path.suffix.lower()
+        for out_path, template_name, first_folder_name, numbers in rename_list:
+            if not out_path.exists():
+                continue
+            try:
+                long_base = build_upload_table_filename(
+                    template_name, first_folder_name, numbers
+                )
+                new_path = output_dir / f"{long_base}{ext}"
+                # Оба пути лежат в output_dir — достаточно сравнить имена, без двух resolve()
+                if new_path.name == out_path.name:
                     continue
-                try:
-                    long_base = build_upload_table_filename(
-                        template_name, first_folder_name, numbers
-                    )
-                    new_path = output_dir / f"{long_base}{ext}"
-                    if new_path.resolve() == out_path.resolve():
-                        continue
-                    out_path.rename(new_path)
-                    print(f"  {COLORS[1]}Переименовано: {out_path.name} → {new_path.name}{RESET}")
-                except OSError as e:
-                    if getattr(e, "winerror", None) == 32 or getattr(e, "errno", None) == 32:
-                        print(f"  {COLORS[2]}[ошибка] {out_path.name}: Файл открыт в другой программе (закройте в Excel){RESET}")
-                    else:
-                        print(f"  {COLORS[2]}[ошибка] {out_path.name}: {e}{RESET}")
-                except Exception as e:
+                out_path.rename(new_path)
+                print(f"  {COLORS[1]}Переименовано: {out_path.name} → {new_path.name}{RESET}")
+            except OSError as e:
+                if getattr(e, "winerror", None) == 32 or getattr(e, "errno", None) == 32:
+                    print(f"  {COLORS[2]}[ошибка] {out_path.name}: Файл открыт в другой программе (закройте в Excel){RESET}")
+                else:
                     print(f"  {COLORS[2]}[ошибка] {out_path.name}: {e}{RESET}")
-            break
-        print("  Введите 1 или 2.")
+            except Exception as e:
+                print(f"  {COLORS[2]}[ошибка] {out_path.name}: {e}{RESET}")
 
     return total_processed
 
@@ -809,11 +1022,18 @@ def main_return_none_on_error() -> int | None:
 
 if __name__ == "__main__":
     total = main_return_none_on_error()
+    # Завершающие строки собираем заранее и пишем одним вызовом
+    closing = []
     if total is not None:
-        print()
         if total == 0:
-            print(f"  {COLORS[0]}Новых листов не добавлено (таблицы обновлены).{RESET}")
+            closing.append(f"\n  {COLORS[0]}Новых листов не добавлено (таблицы обновлены).{RESET}\n")
         else:
-            print(f"  {COLORS[1]}Добавлено листов в таблицы: {total}{RESET}")
-    print(f"\n  {COLORS[4]}Нажмите Enter для выхода...{RESET}")
+            closing.append(f"\n  {COLORS[1]}Добавлено листов в таблицы: {total}{RESET}\n")
+    closing.append(f"\n  {COLORS[4]}Нажмите Enter для выхода...{RESET}\n")
+    # Пока пользователь не нажал Enter, процесс висит — освобождаем кэши и память openpyxl заранее
+    _FIRST_SHEET_NAME_CACHE.clear()
+    _ESD_GTD_CACHE.clear()
+    _FOLDER_STATS_CACHE.clear()
+    gc.collect()
+    sys.stdout.write("".join(closing))
     input()